@@ -1,10 +1,12 @@
 import openpyxl
 from netmiko import ConnectHandler, exceptions
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 import datetime
+import itertools
+import io
 import os
+import re
 import sys
-from tqdm import tqdm
 import time
 import threading
 import colorama  # 添加颜色支持
@@ -22,31 +24,78 @@ COLORS = {
     'CYAN': colorama.Fore.CYAN,
 }
 
+# 可能切换CLI视图的命令，命中后需要重新抓取提示符
+MODE_CHANGE_RE = re.compile(
+    r'^(?:conf(?:ig(?:ure)?)?|system-view|sys|quit|exit|end|return)\b', re.IGNORECASE)
+
+# 命令单元格按行切分用的预编译正则（兼容\r\n并顺带吞掉连续空行）
+CMD_SPLIT_RE = re.compile(r'[\r\n]+')
+
+# 聚合日志写入锁：保证各设备日志在聚合文件里不穿插
+agg_lock = threading.Lock()
+
 # 状态显示锁
 status_lock = threading.Lock()
 
 # 设备状态字典
 device_status = {}
 
+# 状态表格首行设备所在的终端行号（由init_status_display设置）
+STATUS_FIRST_ROW = 5
+
+# IP -> 终端行号，init_status_display按排序一次性算好，刷新时O(1)查表
+status_row = {}
+
+# 总进度行所在的终端行号（由init_status_display设置）
+progress_row = 0
+
+# IP列定宽前缀缓存：IP在整个执行过程中不变，没必要每次刷新都重新格式化
+ip_col = {}
+
 def format_timedelta(seconds):
     """将秒数转换为HH:MM:SS格式"""
     return str(datetime.timedelta(seconds=int(seconds)))
 
-def update_status(ip, status, message="", color=None):
-    """更新设备状态显示"""
+def init_status_display(ips):
+    """清屏一次并打印状态表格骨架，之后仅做单行原地刷新"""
+    global progress_row
     with status_lock:
-        device_status[ip] = (status, message, color)
-        # 清屏并重新显示所有状态
-        os.system('cls' if os.name == 'nt' else 'clear')
-        print("\n======= NetCBDTool - 执行状态 =======\n")
-        
-        # 显示设备状态表格
+        device_status.clear()
+        status_row.clear()
+        ip_col.clear()
+        sys.stdout.write("\x1b[2J\x1b[H")  # 清屏并回到左上角
+        print("======= NetCBDTool - 执行状态 =======\n")
         print(f"{COLORS['CYAN']}{'IP地址':<15} {'状态':<10} {'详细信息':<40}{COLORS['RESET']}")
         print("-" * 65)
-        
-        for dev_ip, (dev_status, dev_msg, dev_color) in sorted(device_status.items()):
-            color_code = dev_color if dev_color else COLORS['RESET']
-            print(f"{color_code}{dev_ip:<15} {dev_status:<10} {dev_msg:<40}{COLORS['RESET']}")
+        ips = sorted(ips)
+        for idx, ip in enumerate(ips):
+            device_status[ip] = ("等待中", "", None)
+            status_row[ip] = STATUS_FIRST_ROW + idx
+            ip_col[ip] = f"{ip:<15} "
+            print(f"{ip_col[ip]}{'等待中':<10} {'':<40}")
+        # 表格下方留一行空行，再放总进度行
+        print()
+        progress_row = STATUS_FIRST_ROW + len(ips) + 1
+        print(f"总体进度 0/{len(ips)}")
+        sys.stdout.flush()
+
+def update_status(ip, status, message="", color=None):
+    """原地刷新单台设备的状态行，避免每次状态变化都整屏重绘"""
+    with status_lock:
+        device_status[ip] = (status, message, color)
+        row = status_row[ip]
+        color_code = color if color else COLORS['RESET']
+        line = f"{color_code}{ip_col[ip]}{status:<10} {message:<40}{COLORS['RESET']}"
+        # 保存光标->定位到设备行->清行->写入->恢复光标
+        sys.stdout.write(f"\x1b[s\x1b[{row};1H\x1b[2K{line}\x1b[u")
+        sys.stdout.flush()
+
+def update_progress(completed, total, succ, err, remaining):
+    """原地刷新表格下方的总进度行"""
+    with status_lock:
+        line = f"总体进度 {completed}/{total}  成功:{succ} 失败:{err}  剩余预估:{remaining}"
+        sys.stdout.write(f"\x1b[s\x1b[{progress_row};1H\x1b[2K{line}\x1b[u")
+        sys.stdout.flush()
 
 def get_user_input():
     print("\n======= NetCBDTool =======")
@@ -83,46 +132,51 @@ def read_command_file(file_path):
 
 def read_devices(filename):
     try:
-        wb = openpyxl.load_workbook(filename)
+        # read_only流式读取，避免整表加载到内存
+        wb = openpyxl.load_workbook(filename, read_only=True, data_only=True)
         ws = wb.active
+        # read_only模式下部分工具生成的表格维度信息缺失，强制重新扫描
+        if ws.calculate_dimension() == "A1:A1":
+            ws.max_row = ws.max_column = None
         devices = []
-        valid_count = 0  
+        valid_count = 0
         error_count = 0
-        
-        for row_idx, row in enumerate(ws.iter_rows(min_row=2), start=2):
+        # 同一命令文件通常被多台设备引用，按绝对路径缓存避免重复读盘
+        cmd_file_cache = {}
+
+        for row_idx, values in enumerate(ws.iter_rows(min_row=2, values_only=True), start=2):
             try:
-                ip = safe_strip(row[0].value)
+                # values_only直接拿到原始值元组，不构造Cell对象；行宽不足时补齐到7列
+                ip, port_value, username, password, secret, device_type, raw_commands = \
+                    (safe_strip(v) for v in (tuple(values) + (None,) * 7)[:7])
+
                 if not ip:
                     continue
 
-                port_value = safe_strip(row[1].value)
                 try:
                     port = int(port_value) if port_value else 22
                 except ValueError:
                     raise ValueError(f"无效端口号：'{port_value}'")
 
-                username = safe_strip(row[2].value)
-                password = safe_strip(row[3].value)
                 if not username or not password:
                     raise ValueError("用户名或密码为空")
 
-                device_type = safe_strip(row[5].value)
                 if not device_type:
                     raise ValueError("设备类型为空")
-
-                raw_commands = safe_strip(row[6].value)
                 commands = []
                 
-                # 处理每一行的命令
-                for line in raw_commands.split('\n'):
+                # 处理每一行的命令：一次正则切分整个单元格，保持文件/内联命令的原始顺序
+                for line in CMD_SPLIT_RE.split(raw_commands):
                     line = line.strip()
                     if not line:
                         continue
-                    
+
                     # 如果行以.txt结尾，视为文件路径
                     if line.lower().endswith('.txt'):
-                        file_commands = read_command_file(line)
-                        commands.extend(file_commands)
+                        cache_key = os.path.abspath(line)
+                        if cache_key not in cmd_file_cache:
+                            cmd_file_cache[cache_key] = read_command_file(line)
+                        commands.extend(cmd_file_cache[cache_key])
                     else:
                         commands.append(line)
 
@@ -131,7 +185,7 @@ def read_devices(filename):
                     'port': port,
                     'username': username,
                     'password': password,
-                    'secret': safe_strip(row[4].value),
+                    'secret': secret,
                     'device_type': device_type,
                     'commands': commands,
                 })
@@ -141,6 +195,9 @@ def read_devices(filename):
                 error_count += 1
                 print(f"第{row_idx}行错误：{str(e)}")
 
+        # read_only模式会保持zip句柄打开，遍历完必须显式关闭
+        wb.close()
+
         print(f"\n[设备统计] 检测到有效设备{valid_count}台")  # 新输出格式
         if error_count > 0:
             print(f"[数据警告] 发现{error_count}行格式错误数据")
@@ -154,13 +211,91 @@ def read_devices(filename):
         print(f"文件读取失败：{str(e)}")
         return None
 
-def worker(device, thread_num, log_folder, timestamp):
+# 单设备日志缓冲上限：超过即落盘，防止show tech类大回显在内存里堆积
+LOG_FLUSH_THRESHOLD = 256 * 1024
+# 日志文件头部预留的定宽状态区（执行结束后回填[Success]/[Error]行）
+LOG_HEADER_SIZE = 128
+
+def flush_log_buffer(fd, buf):
+    """把StringIO缓冲一次os.write落盘并清空"""
+    data = buf.getvalue()
+    if data:
+        os.write(fd, data.encode('utf-8'))
+        buf.seek(0)
+        buf.truncate()
+
+# 跨轮次SSH会话池：同一批设备反复下发时复用已建立的会话，省掉TCP+KEX+认证
+device_pool = {}
+pool_lock = threading.Lock()
+POOL_IDLE_TIMEOUT = 300  # 空闲超过5分钟的会话由回收线程断开
+
+def pool_key(device):
+    return (device['ip'], device['port'], device['username'], device['device_type'])
+
+def acquire_connection(device):
+    """优先复用会话池里的活连接，没有可用的才重新握手"""
+    key = pool_key(device)
+    while True:
+        with pool_lock:
+            sessions = device_pool.get(key)
+            if not sessions:
+                break
+            conn, _ = sessions.pop()
+        if conn.is_alive():
+            return conn
+        try:
+            conn.disconnect()
+        except Exception:
+            pass
+    return ConnectHandler(
+        ip=device['ip'],
+        port=device['port'],
+        username=device['username'],
+        password=device['password'],
+        secret=device['secret'] or None,
+        device_type=device['device_type'],
+        conn_timeout=30
+    )
+
+def release_connection(device, conn):
+    """把仍然存活的会话放回池里，供下一轮执行复用"""
+    with pool_lock:
+        device_pool.setdefault(pool_key(device), []).append((conn, time.time()))
+
+def reap_idle_connections():
+    """后台回收线程：定期断开池中长时间空闲的会话"""
+    while True:
+        time.sleep(60)
+        cutoff = time.time() - POOL_IDLE_TIMEOUT
+        stale = []
+        with pool_lock:
+            for key, sessions in list(device_pool.items()):
+                alive = [(conn, ts) for conn, ts in sessions if ts >= cutoff]
+                stale.extend(conn for conn, ts in sessions if ts < cutoff)
+                if alive:
+                    device_pool[key] = alive
+                else:
+                    del device_pool[key]
+        for conn in stale:
+            try:
+                conn.disconnect()
+            except Exception:
+                pass
+
+def worker(device, thread_num, log_folder, timestamp, agg_fd):
     ip_clean = device['ip']
     log_filename = f"线程{thread_num}_{ip_clean}_{timestamp}.txt"  # 文件名格式调整
     log_path = os.path.join(log_folder, log_filename)
-    log_content = []
+    buf = io.StringIO()  # 单一缓冲区，避免反复拼接字符串列表
     error_info = None  # 新增错误信息记录
-    
+
+    # 裸fd直写：绕过Python缓冲层，每次flush就是一次系统调用
+    fd = os.open(log_path,
+                 os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0),
+                 0o644)
+    # 预留定宽状态行，收尾时seek回来改写
+    os.write(fd, b' ' * (LOG_HEADER_SIZE - 2) + b'\n\n')
+
     # 初始化设备状态
     update_status(device['ip'], "准备中", "等待连接...", COLORS['BLUE'])
 
@@ -168,37 +303,36 @@ def worker(device, thread_num, log_folder, timestamp):
         # 更新状态为连接中
         update_status(device['ip'], "连接中", f"尝试连接 {device['ip']}:{device['port']}...", COLORS['YELLOW'])
         
-        conn = ConnectHandler(
-            ip=device['ip'],
-            port=device['port'],
-            username=device['username'],
-            password=device['password'],
-            secret=device['secret'] or None,
-            device_type=device['device_type'],
-            conn_timeout=30
-        )
+        conn = acquire_connection(device)
 
         update_status(device['ip'], "已连接", "认证成功，准备执行命令", COLORS['GREEN'])
 
         if device['secret']:
             conn.enable()
 
+        # 提示符缓存一次即可，find_prompt()每次调用都是一个完整网络往返
+        prompt = conn.find_prompt()
+
         # 执行命令
         for i, cmd in enumerate(device['commands']):
             cmd_display = (cmd[:37] + '...') if len(cmd) > 40 else cmd
             update_status(device['ip'], "执行中", f"命令 {i+1}/{len(device['commands'])}: {cmd_display}", COLORS['CYAN'])
             
             output = conn.send_command_timing(cmd, strip_command=False)
-            log_content.append(f"{conn.find_prompt()} {cmd}\n{output}\n{'='*60}\n")
+            buf.write(f"{prompt} {cmd}\n{output}\n{'='*60}\n")
+            if MODE_CHANGE_RE.match(cmd):
+                prompt = conn.find_prompt()  # 视图切换后提示符会变
+            if buf.tell() > LOG_FLUSH_THRESHOLD:
+                flush_log_buffer(fd, buf)
 
-        # 发送确认命令
+        # 收尾确认：一次短读即可，之前3次空send_command_timing每次都要等读超时
         update_status(device['ip'], "完成中", "发送确认命令...", COLORS['CYAN'])
-        for _ in range(3):
-            output = conn.send_command_timing("")
-            log_content.append(output)
+        conn.write_channel("\n")
+        time.sleep(0.2)
+        buf.write(conn.read_channel())
 
-        conn.disconnect()
-        log_content.insert(0, f"[Success] {device['ip']} 配置成功\n\n")
+        # 会话放回池中而不是断开，下一轮执行免去重新握手
+        release_connection(device, conn)
         update_status(device['ip'], "成功", "所有命令执行完成", COLORS['GREEN'])
         
     except exceptions.NetmikoAuthenticationException as e:
@@ -210,7 +344,7 @@ def worker(device, thread_num, log_folder, timestamp):
             'error_type': '认证失败',
             'error_msg': str(e)
         }
-        log_content = [f"[Error] {device['ip']} 认证失败：用户名/密码错误\n"]
+        log_text = f"[Error] {device['ip']} 认证失败：用户名/密码错误\n"
     except exceptions.NetmikoTimeoutException as e:
         error_info = {
             'ip': device['ip'],
@@ -220,7 +354,7 @@ def worker(device, thread_num, log_folder, timestamp):
             'error_type': '连接超时',
             'error_msg': str(e)
         }
-        log_content = [f"[Error] {device['ip']} 连接超时：端口{device['port']}不可达\n"]
+        log_text = f"[Error] {device['ip']} 连接超时：端口{device['port']}不可达\n"
     except Exception as e:
         error_info = {
             'ip': device['ip'],
@@ -230,18 +364,48 @@ def worker(device, thread_num, log_folder, timestamp):
             'error_type': '未知错误',
             'error_msg': str(e)
         }
-        log_content = [f"[Error] {device['ip']} 发生未知错误：{str(e)}\n"]
-
-    with open(log_path, 'w', encoding='utf-8') as f:
-        f.writelines(log_content)
+        log_text = f"[Error] {device['ip']} 发生未知错误：{str(e)}\n"
+
+    if error_info is None:
+        flush_log_buffer(fd, buf)
+        # 回填成功状态行
+        os.lseek(fd, 0, os.SEEK_SET)
+        os.write(fd, f"[Success] {device['ip']} 配置成功".encode('utf-8').ljust(LOG_HEADER_SIZE - 2))
+    else:
+        # 失败时丢弃已落盘的部分输出，仅保留错误行
+        os.ftruncate(fd, 0)
+        os.lseek(fd, 0, os.SEEK_SET)
+        os.write(fd, log_text.encode('utf-8'))
+    os.close(fd)
+
+    # 聚合日志由worker直接追加：共享O_APPEND fd，锁内流式拷贝刚写完的设备日志
+    with agg_lock:
+        os.write(agg_fd, f"[[ {log_filename} ]]\n".encode('utf-8'))
+        with open(log_path, 'rb') as src:
+            while True:
+                chunk = src.read(1024 * 1024)
+                if not chunk:
+                    break
+                os.write(agg_fd, chunk)
+        os.write(agg_fd, b"\n\n")
 
     return thread_num, log_filename, error_info
 
+def write_error_workbook(error_devices, path):
+    """把登录失败汇总导出为xlsx。write_only模式逐行落盘，行数再多内存也不涨"""
+    wb = openpyxl.Workbook(write_only=True)
+    ws = wb.create_sheet('登录失败汇总')
+    ws.append(['IP地址', '端口', '用户名', '设备类型', '错误类型', '错误信息'])
+    for dev in error_devices:
+        ws.append([dev['ip'], dev['port'], dev['username'],
+                   dev['device_type'], dev['error_type'], dev['error_msg']])
+    wb.save(path)
+
 def main_loop():
+    # 会话池空闲回收线程，随主程序退出
+    threading.Thread(target=reap_idle_connections, daemon=True).start()
+
     while True:
-        # 清空设备状态
-        device_status.clear()
-        
         filename, max_workers = get_user_input()
         
         # 读取设备列表
@@ -258,54 +422,58 @@ def main_loop():
         log_folder = f"执行结果_{timestamp}"
         os.makedirs(log_folder, exist_ok=True)
 
+        # 打印一次状态表格骨架，后续状态变化只刷新对应行
+        init_status_display(d['ip'] for d in devices)
+
+        # 大并发时缩小线程栈，默认8MB的栈在200线程下白白占用虚拟内存
+        try:
+            threading.stack_size(1 << 20)
+        except (ValueError, RuntimeError):
+            pass  # 平台不支持自定义栈大小时维持默认值
+
+        # 聚合日志：共享追加fd，各worker完成时自行写入，主线程不再经手
+        aggregate_log = os.path.join(log_folder, f"聚合日志_{timestamp}.txt")
+        agg_fd = os.open(aggregate_log,
+                         os.O_WRONLY | os.O_CREAT | os.O_APPEND | getattr(os, 'O_BINARY', 0),
+                         0o644)
+
         # 执行任务
         with ThreadPoolExecutor(max_workers=max_workers) as executor:
             start_time = time.time()
             completed = 0
             total = len(devices)
-            
-            # 优化进度条配置
-            with tqdm(
-                total=total,
-                desc="总体进度",
-                unit="台",
-                bar_format="{l_bar}{bar}| {n_fmt}/{total_fmt} [已用:{elapsed} 剩余预估:{remaining}]",
-                dynamic_ncols=True,
-                smoothing=0.9,
-                position=0,  # 固定进度条位置
-                leave=True   # 保留进度条
-            ) as progress:
-                
-                # 提交任务
-                futures = {executor.submit(worker, device, i+1, log_folder, timestamp): i 
-                          for i, device in enumerate(devices)}
-                
-                # 处理结果
-                log_files = []
-                error_devices = []
-                time_records = []
-                
-                for future in as_completed(futures):
+
+            # 滑动窗口提交：在途Future不超过max_workers*2，设备再多队列内存也有界
+            error_devices = []
+            time_records = []
+            device_iter = iter(enumerate(devices, start=1))
+            pending = {executor.submit(worker, device, num, log_folder, timestamp, agg_fd)
+                       for num, device in itertools.islice(device_iter, max_workers * 2)}
+
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                # 每完成一个就补提一个，窗口大小保持不变
+                for num, device in itertools.islice(device_iter, len(done)):
+                    pending.add(executor.submit(worker, device, num, log_folder, timestamp, agg_fd))
+
+                for future in done:
                     thread_num, log_filename, error_info = future.result()
                     exec_time = time.time() - start_time  # 使用全局时间简化计算
-                    
+
                     # 更新统计
                     completed += 1
                     time_records.append(exec_time)
                     avg_time = sum(time_records)/completed if completed else 0
                     remaining = format_timedelta(avg_time * (total - completed)) if completed else "00:00:00"
-                    
-                    # 动态更新进度条
-                    progress.set_postfix_str(f"成功:{completed-len(error_devices)} 失败:{len(error_devices)} 剩余预估:{remaining}")
-                    progress.update(1)
-                    
-                    # 处理日志
-                    log_files.append(log_filename)
+
                     if error_info:
                         error_devices.append(error_info)
 
-            # 清理资源
-            progress.close()
+                    # 总进度行与状态表格同屏原地刷新，不再引入tqdm的独立渲染和锁
+                    update_progress(completed, total,
+                                    completed - len(error_devices), len(error_devices), remaining)
+
+        os.close(agg_fd)
 
         # 清屏并显示最终结果
         os.system('cls' if os.name == 'nt' else 'clear')
@@ -333,16 +501,9 @@ def main_loop():
                     f.write(f"   错误类型：{dev['error_type']}\n")
                     f.write(f"   错误信息：{dev['error_msg']}\n")
                     f.write("-"*60 + "\n\n")
-
-        # 生成聚合日志
-        aggregate_log = os.path.join(log_folder, f"聚合日志_{timestamp}.txt")
-        with open(aggregate_log, 'w', encoding='utf-8') as agg_f:
-            for log_file in log_files:
-                file_path = os.path.join(log_folder, log_file)
-                with open(file_path, 'r', encoding='utf-8') as f:
-                    agg_f.write(f"[[ {log_file} ]]\n")
-                    agg_f.writelines(f.readlines())
-                    agg_f.write("\n\n")
+            # 同步导出xlsx版本，方便在表格里筛选失败设备
+            write_error_workbook(error_devices,
+                                 os.path.join(log_folder, f"登录失败汇总_{timestamp}.xlsx"))
 
         # 修改后的完成提示
         print(f"\n{COLORS['GREEN']}操作完成！成功下发设备：{len(devices)-len(error_devices)}台{COLORS['RESET']}")